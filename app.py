@@ -1,16 +1,55 @@
+import atexit
+import os
+
+# Size the OpenMP/MKL thread pools before numpy, faiss and torch are imported.
+# The encoder and FAISS run concurrently, so each gets half the cores instead of both taking all of them
+CPU_COUNT = os.cpu_count() or 1
+HALF_CPU_COUNT = max(1, CPU_COUNT // 2)
+os.environ.setdefault("OMP_NUM_THREADS", str(HALF_CPU_COUNT))
+os.environ.setdefault("MKL_NUM_THREADS", str(HALF_CPU_COUNT))
+# Tokenizer threads would fight the encoder for cores (and warn after gunicorn forks)
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+# Probe CUDA through NVML, so checking for a GPU doesn't initialize CUDA in the gunicorn master
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+
 import pickle
 import faiss
-from flask import Flask, request, jsonify, render_template_string
+import gzip
+import numpy as np
+from flask import Flask, Response, request, jsonify
 from sentence_transformers import SentenceTransformer
 from huggingface_hub import hf_hub_download
-import hashlib
+from huggingface_hub.utils import EntryNotFoundError
+import httpx
+import xxhash
+from cachetools import LRUCache, TTLCache, cached
+import json
+import mmap
+import queue
 import re
-import os
+import string
 import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import torch
+
+# Some container runtimes leave torch single-threaded; set both pools explicitly
+# (an OMP_NUM_THREADS set by the deployment applies to both unless overridden per library)
+OMP_NUM_THREADS = int(os.environ["OMP_NUM_THREADS"])
+TORCH_NUM_THREADS = int(os.environ.get("TORCH_NUM_THREADS", OMP_NUM_THREADS))
+FAISS_NUM_THREADS = int(os.environ.get("FAISS_NUM_THREADS", OMP_NUM_THREADS))
+torch.set_num_threads(TORCH_NUM_THREADS)
+torch.set_num_interop_threads(1)
+# Inference only - no autograd bookkeeping anywhere in the process
+torch.set_grad_enabled(False)
+# Let float32 matmuls use reduced-precision kernels (TF32/bf16) where the hardware has them
+torch.set_float32_matmul_precision("medium")
+faiss.omp_set_num_threads(FAISS_NUM_THREADS)
 
 # Import Groq
 try:
-    from groq import Groq
+    from groq import APITimeoutError, Groq
     GROQ_AVAILABLE = True
 except ImportError:
     print("❌ ERROR: groq package not installed!")
@@ -18,7 +57,61 @@ except ImportError:
     GROQ_AVAILABLE = False
     sys.exit(1)
 
+# Import ONNX Runtime (optional - falls back to PyTorch SentenceTransformer)
+try:
+    import onnxruntime as ort
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
+# Import Flask-Compress (optional - responses are sent uncompressed without it)
+try:
+    from flask_compress import Compress
+    COMPRESS_AVAILABLE = True
+except ImportError:
+    COMPRESS_AVAILABLE = False
+
+# Import orjson (optional - Flask's stdlib json provider is used without it)
+try:
+    import orjson
+    from flask.json.provider import JSONProvider
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Import zstandard (optional - falls back to the uncompressed chunk pickles)
+try:
+    import zstandard as zstd
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+# Import fcntl (optional - POSIX only; without it concurrent cache saves are last-writer-wins)
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
 app = Flask(__name__)
+if ORJSON_AVAILABLE:
+    class ORJSONProvider(JSONProvider):
+        """
+        Serves request.json and jsonify() through orjson instead of the stdlib json module
+        """
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj).decode("utf-8")
+        
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+    
+    app.json = ORJSONProvider(app)
+if COMPRESS_AVAILABLE:
+    # gzip/br for the page and the MCQ JSON
+    Compress(app)
 
 print("=" * 50)
 print("STARTING MCQ GENERATOR APP")
@@ -90,6 +183,16 @@ print("\nStep 1: Checking Groq API Key...")
 print("-" * 50)
 
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY", "").strip()
+GROQ_TIMEOUT = float(os.environ.get("GROQ_TIMEOUT", 30))
+
+def create_groq_client():
+    # One long-lived pooled HTTP/2 client, so Groq calls reuse the TLS connection
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=60),
+        timeout=GROQ_TIMEOUT
+    )
+    return Groq(api_key=GROQ_API_KEY, http_client=http_client)
 
 if not GROQ_API_KEY:
     print("❌ GROQ_API_KEY not found!")
@@ -104,31 +207,228 @@ else:
     print(f"✓ GROQ_API_KEY found ({len(GROQ_API_KEY)} chars)")
     print(f"  First 20 chars: {GROQ_API_KEY[:20]}...")
     
+    # No test call here - the API is probed lazily by /health, so restarts skip a network round trip
     try:
-        groq_client = Groq(api_key=GROQ_API_KEY)
-        
-        # Test the API
-        print("  Testing API connection...")
-        test = groq_client.chat.completions.create(
-            messages=[{"role": "user", "content": "test"}],
-            model="llama-3.3-70b-versatile",
-            max_tokens=5
-        )
-        print("✓ Groq API working!")
+        groq_client = create_groq_client()
+        print("✓ Groq client created")
         
     except Exception as e:
         print(f"❌ Groq API initialization failed:")
         print(f"   Error: {str(e)}")
         groq_client = None
 
+def _reset_groq_client():
+    # Forked workers (gunicorn --preload) must not share the parent's pooled connections
+    global groq_client
+    if groq_client is not None:
+        groq_client = create_groq_client()
+
+os.register_at_fork(after_in_child=_reset_groq_client)
+
+# Groq calls run on a shared pool so a hung request times out instead of wedging a gunicorn thread
+# (pool threads start on first submit, so each forked worker gets its own).
+# Twice the request threads, so calls still stuck past their timeout can't starve new ones of a slot
+GROQ_EXECUTOR = ThreadPoolExecutor(
+    max_workers=2 * int(os.environ.get("THREADS", 8)),
+    thread_name_prefix="groq"
+)
+
+def groq_chat(**kwargs):
+    """
+    Run a Groq chat completion on GROQ_EXECUTOR, raising TimeoutError after GROQ_TIMEOUT seconds
+    """
+    future = GROQ_EXECUTOR.submit(groq_client.chat.completions.create, **kwargs)
+    try:
+        return future.result(timeout=GROQ_TIMEOUT)
+    except FutureTimeoutError:
+        # The request has failed either way; a call still queued must not run (and bill tokens) later
+        future.cancel()
+        raise
+
 print("-" * 50)
 
 # ------------------------------
 # Load embedding model (CPU)
 # ------------------------------
+EMBED_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+ONNX_CACHE_DIR = os.environ.get("ONNX_CACHE_DIR", "minilm_int8_onnx")
+ONNX_QUANTIZED_FILE = "model_quantized.onnx"
+# Topics and chapter titles are short; 128 tokens bounds the encoder cost of pathological inputs
+EMBED_MAX_SEQ_LENGTH = 128
+
+def cpu_has_flag(flag):
+    """
+    Check /proc/cpuinfo for an instruction-set flag (False where it can't be read)
+    """
+    try:
+        with open("/proc/cpuinfo") as f:
+            return any(flag in line.split() for line in f if line.startswith("flags"))
+    except OSError:
+        return False
+
+class OnnxEncoder:
+    """
+    all-MiniLM-L6-v2 exported to ONNX with dynamic int8 quantization
+    Exposes the same encode() call shape as SentenceTransformer
+    """
+    def __init__(self, model_id, cache_dir, max_seq_length=EMBED_MAX_SEQ_LENGTH):
+        # Export once; later starts load the quantized model straight from disk
+        if not os.path.exists(os.path.join(cache_dir, ONNX_QUANTIZED_FILE)):
+            print("  Exporting and quantizing ONNX model (first run only)...")
+            self.export(model_id, cache_dir)
+        
+        self.cache_dir = cache_dir
+        self.load_session()
+        self.tokenizer = AutoTokenizer.from_pretrained(cache_dir, use_fast=True)
+        self.max_seq_length = max_seq_length
+    
+    def load_session(self):
+        """
+        (Re)create the ONNX Runtime session; its intra-op thread pool doesn't survive fork()
+        """
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = TORCH_NUM_THREADS
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            self.cache_dir, file_name=ONNX_QUANTIZED_FILE, session_options=sess_options
+        )
+    
+    @staticmethod
+    def export(model_id, cache_dir):
+        # Export to ONNX, then quantize the MatMul weights to int8 (VNNI kernels where the CPU has them)
+        model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+        model.save_pretrained(cache_dir)
+        AutoTokenizer.from_pretrained(model_id, use_fast=True).save_pretrained(cache_dir)
+        
+        quantizer = ORTQuantizer.from_pretrained(model)
+        if cpu_has_flag("avx512_vnni"):
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        else:
+            qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=cache_dir, quantization_config=qconfig)
+    
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, **kwargs):
+        if isinstance(sentences, str):
+            sentences = [sentences]
+        
+        batches = []
+        for start in range(0, len(sentences), batch_size):
+            enc = self.tokenizer(
+                sentences[start:start + batch_size],
+                padding=True, truncation=True, max_length=self.max_seq_length, return_tensors="np"
+            )
+            hidden = self.model(**enc).last_hidden_state
+            
+            # Mean pooling over real (non-padding) tokens, as in the SentenceTransformer model
+            mask = enc["attention_mask"][..., None].astype(np.float32)
+            batches.append((hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+        
+        embs = np.vstack(batches).astype(np.float32)
+        if normalize_embeddings:
+            embs /= np.clip(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12, None)
+        return embs
+
+class TorchEncoder:
+    """
+    Runs the SentenceTransformer modules directly (tokenizer -> transformer -> pooling)
+    Skips the DataLoader and progress-bar setup in encode(), which dominate single-query latency
+    """
+    def __init__(self, model, max_seq_length=EMBED_MAX_SEQ_LENGTH):
+        self.tokenizer = model.tokenizer
+        self.transformer = model[0].auto_model
+        self.pooling = model[1]
+        self.max_seq_length = max_seq_length
+        self.device = model.device
+    
+    def to(self, device):
+        """
+        Move the model to `device` (fp16 on CUDA); called per worker, after fork
+        """
+        self.transformer.to(device)
+        if device == "cuda":
+            # fp16 halves activation bandwidth; encode() still returns float32 embeddings
+            self.transformer.half()
+        self.device = torch.device(device)
+    
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, **kwargs):
+        if isinstance(sentences, str):
+            sentences = [sentences]
+        
+        batches = []
+        with torch.inference_mode():
+            for start in range(0, len(sentences), batch_size):
+                enc = self.tokenizer(
+                    sentences[start:start + batch_size],
+                    padding=True, truncation=True, max_length=self.max_seq_length, return_tensors="pt"
+                ).to(self.device)
+                out = self.transformer(**enc)
+                emb = self.pooling({
+                    "token_embeddings": out.last_hidden_state,
+                    "attention_mask": enc["attention_mask"]
+                })["sentence_embedding"]
+                
+                if normalize_embeddings:
+                    emb = torch.nn.functional.normalize(emb, p=2, dim=1)
+                batches.append(emb.cpu().numpy())
+        
+        return np.vstack(batches).astype(np.float32)
+
+def detect_device():
+    """
+    Pick the fastest available torch device: CUDA, then Apple MPS, then CPU
+    """
+    if torch.cuda.is_available():
+        return "cuda"
+    if getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+EMBED_DEVICE = detect_device()
+
 print("\nStep 2: Loading embedding model...")
-embed_model = SentenceTransformer("all-MiniLM-L6-v2")
-print("✓ Embedding model loaded")
+embed_model = None
+# The int8 ONNX model is the fast path on CPU; on a GPU the torch model is faster
+if ONNX_AVAILABLE and EMBED_DEVICE == "cpu":
+    try:
+        embed_model = OnnxEncoder(EMBED_MODEL_ID, ONNX_CACHE_DIR)
+        print("✓ Embedding model loaded (int8 ONNX Runtime)")
+    except Exception as e:
+        print(f"⚠️ ONNX export failed, falling back to PyTorch: {e}")
+
+if embed_model is None:
+    # Loaded on CPU here (the gunicorn master must not touch CUDA before forking);
+    # init_worker() moves it to EMBED_DEVICE in each worker
+    embed_model = TorchEncoder(SentenceTransformer("all-MiniLM-L6-v2", device="cpu"))
+    print(f"✓ Embedding model loaded (PyTorch, {EMBED_DEVICE} after worker start)")
+
+# all-MiniLM-L6-v2 output size, known before anything is encoded
+EMBED_DIM = 384
+
+CHAPTER_MATCH_THRESHOLD = 0.35
+SUBJECT_MARGIN = 0.05
+
+# Subject of each row of the stacked chapter embeddings
+CHAPTER_SUBJECT = np.array([subject for subject, chapters in CHAPTER_NAMES.items() for _ in chapters])
+
+_chapter_emb = None
+_chapter_emb_lock = threading.Lock()
+
+def chapter_embeddings():
+    """
+    Chapter titles never change, so embed them once per process and match topics by cosine similarity
+    Returns (per-subject embeddings, all chapters stacked); the stacked copy classifies a topic's
+    subject without an LLM call. Not done at import: under gunicorn's preload that would run the
+    encoder (and its OpenMP team) in the master, and a forked worker can then hang on its first encode
+    """
+    global _chapter_emb
+    with _chapter_emb_lock:
+        if _chapter_emb is None:
+            per_subject = {
+                subject: embed_model.encode(chapters, normalize_embeddings=True, show_progress_bar=False)
+                for subject, chapters in CHAPTER_NAMES.items()
+            }
+            _chapter_emb = (per_subject, np.vstack([per_subject[subject] for subject in CHAPTER_NAMES]))
+            print(f"✓ Chapter embeddings ready ({len(CHAPTER_SUBJECT)} chapters, pid {os.getpid()})")
+        return _chapter_emb
 
 # ------------------------------
 # Download files from Hugging Face
@@ -138,14 +438,25 @@ REPO_ID = "Redfire-1234/pcb_tutor"
 print("\nStep 3: Downloading subject files...")
 print("-" * 50)
 
+def download_chunks(filename):
+    """
+    Prefer the zstd-compressed chunk pickle (several times smaller to download), else the plain one
+    """
+    if ZSTD_AVAILABLE:
+        try:
+            return hf_hub_download(repo_id=REPO_ID, filename=filename + ".zst", repo_type="model")
+        except EntryNotFoundError:
+            pass
+    return hf_hub_download(repo_id=REPO_ID, filename=filename, repo_type="model")
+
 try:
-    bio_chunks_path = hf_hub_download(repo_id=REPO_ID, filename="bio_chunks.pkl", repo_type="model")
+    bio_chunks_path = download_chunks("bio_chunks.pkl")
     faiss_bio_path = hf_hub_download(repo_id=REPO_ID, filename="faiss_bio.bin", repo_type="model")
     
-    chem_chunks_path = hf_hub_download(repo_id=REPO_ID, filename="chem_chunks.pkl", repo_type="model")
+    chem_chunks_path = download_chunks("chem_chunks.pkl")
     faiss_chem_path = hf_hub_download(repo_id=REPO_ID, filename="faiss_chem.bin", repo_type="model")
     
-    phy_chunks_path = hf_hub_download(repo_id=REPO_ID, filename="phy_chunks.pkl", repo_type="model")
+    phy_chunks_path = download_chunks("phy_chunks.pkl")
     faiss_phy_path = hf_hub_download(repo_id=REPO_ID, filename="faiss_phy.bin", repo_type="model")
     
     print("✓ All files downloaded")
@@ -153,26 +464,205 @@ except Exception as e:
     print(f"❌ Error downloading files: {e}")
     sys.exit(1)
 
-# Load all subjects into memory
-print("\nStep 4: Loading subject data into memory...")
-SUBJECTS = {
-    "biology": {
-        "chunks": pickle.load(open(bio_chunks_path, "rb")),
-        "index": faiss.read_index(faiss_bio_path)
-    },
-    "chemistry": {
-        "chunks": pickle.load(open(chem_chunks_path, "rb")),
-        "index": faiss.read_index(faiss_chem_path)
-    },
-    "physics": {
-        "chunks": pickle.load(open(phy_chunks_path, "rb")),
-        "index": faiss.read_index(faiss_phy_path)
-    }
-}
+# ------------------------------
+# Subject data (loaded on first use)
+# ------------------------------
+HNSW_EF_SEARCH = int(os.environ.get("EF_SEARCH", 64))
+IVF_NPROBE = int(os.environ.get("NPROBE", 8))
+# Only GPU builds of faiss have StandardGpuResources. Whether a GPU is actually present is checked
+# on first load, in the worker: get_num_gpus() initializes CUDA, which must not happen before fork
+FAISS_GPU_BUILD = hasattr(faiss, "StandardGpuResources")
+
+class ChunkStore:
+    """
+    Text chunks packed into one UTF-8 blob plus an offsets array
+    Avoids keeping a separate Python str object per chunk; loaded stores are mmapped,
+    so the text stays in the page cache (shared across workers) until a chunk is sliced out
+    """
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+    
+    @classmethod
+    def from_list(cls, chunks):
+        encoded = [chunk.encode("utf-8") for chunk in chunks]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(b"".join(encoded), offsets)
+    
+    @classmethod
+    def load(cls, base_path):
+        with open(base_path + ".blob", "rb") as f:
+            # mmap can't map an empty file
+            blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        return cls(blob, np.load(base_path + ".offsets.npy", mmap_mode="r"))
+    
+    @staticmethod
+    def exists(base_path):
+        # Offsets are written last, so their presence means the blob is complete
+        return os.path.exists(base_path + ".offsets.npy")
+    
+    def save(self, base_path):
+        # Another worker may have the blob mmapped already, so never truncate it in place:
+        # write to tmp files and swap them in, blob first and offsets (the completeness marker) last
+        pid = os.getpid()
+        with open(f"{base_path}.blob.{pid}.tmp", "wb") as f:
+            f.write(self.blob)
+        with open(f"{base_path}.offsets.{pid}.tmp", "wb") as f:
+            np.save(f, self.offsets)
+        os.replace(f"{base_path}.blob.{pid}.tmp", base_path + ".blob")
+        os.replace(f"{base_path}.offsets.{pid}.tmp", base_path + ".offsets.npy")
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+    
+    def join(self, ids, sep="\n\n", limit=None):
+        """
+        Join the chunks for a row of FAISS result ids, decoding only as many as fit in `limit` chars
+        """
+        # FAISS pads rows with -1 when fewer than k neighbours are found
+        ids = ids[(ids >= 0) & (ids < len(self))]
+        parts, total = [], 0
+        for start, end in zip(self.offsets[ids].tolist(), self.offsets[ids + 1].tolist()):
+            parts.append(self.blob[start:end].decode("utf-8"))
+            total += len(parts[-1]) + len(sep)
+            if limit is not None and total >= limit:
+                break
+        
+        context = sep.join(parts)
+        return context[:limit] if limit is not None else context
+
+class LockedIndex:
+    """
+    Serializes search() on a GPU index; everything else passes through to the index
+    GPU indices (and the StandardGpuResources they share) are not thread-safe, while the
+    batcher thread, the subject-search pool and the warm-up can all search at once
+    """
+    def __init__(self, index, lock):
+        self._index = index
+        self._lock = lock
+    
+    def search(self, *args, **kwargs):
+        with self._lock:
+            return self._index.search(*args, **kwargs)
+    
+    def __getattr__(self, name):
+        return getattr(self._index, name)
+
+class SubjectLoader:
+    """
+    Loads a subject's chunks and FAISS index the first time it is requested
+    Keeps at most `max_resident` chunk stores in memory, dropping the least recently used.
+    Indices are outside that cap and stay loaded once read, since the retrieval fallback searches
+    every subject's. Flat and HNSW indices sit on each worker's heap, so every worker ends up holding
+    roughly the combined size of the faiss_*.bin files on top of its resident chunk stores
+    """
+    def __init__(self, paths, max_resident=2):
+        self._paths = paths
+        self.max_resident = max_resident
+        self._cache = LRUCache(maxsize=max_resident)
+        self._indexes = {}
+        self._lock = threading.Lock()
+        # One GPU allocator shared by every subject index, created on first load (after any fork),
+        # and one lock for all their searches
+        self._gpu_resources = None
+        self._gpu_lock = threading.Lock()
+    
+    def __contains__(self, subject):
+        return subject in self._paths
+    
+    def __iter__(self):
+        return iter(self._paths)
+    
+    def __getitem__(self, subject):
+        with self._lock:
+            chunks = self._cache.get(subject)
+            if chunks is None:
+                chunks = self._load_chunks(subject)
+                self._cache[subject] = chunks
+            return {"chunks": chunks, "index": self._get_index(subject)}
+    
+    def index(self, subject):
+        """
+        Just the FAISS index, without touching the chunk LRU
+        """
+        with self._lock:
+            return self._get_index(subject)
+    
+    def _get_index(self, subject):
+        # Caller holds self._lock
+        index = self._indexes.get(subject)
+        if index is None:
+            index = self._indexes[subject] = self._load_index(subject)
+        return index
+    
+    def _load_chunks(self, subject):
+        chunks_path, _ = self._paths[subject]
+        
+        # Packed copy next to the downloaded pickle (same hub snapshot), built on first load
+        packed_path = os.path.splitext(chunks_path.removesuffix(".zst"))[0]
+        if ChunkStore.exists(packed_path):
+            chunks = ChunkStore.load(packed_path)
+        else:
+            if chunks_path.endswith(".zst"):
+                # Decompress while unpickling, without holding the whole decompressed pickle in memory
+                with open(chunks_path, "rb") as f, zstd.ZstdDecompressor().stream_reader(f) as reader:
+                    chunks = ChunkStore.from_list(pickle.load(reader))
+            else:
+                with open(chunks_path, "rb") as f:
+                    chunks = ChunkStore.from_list(pickle.load(f))
+            try:
+                chunks.save(packed_path)
+                # Swap the heap copy for the mmapped one
+                chunks = ChunkStore.load(packed_path)
+            except OSError as e:
+                print(f"⚠️ Could not save packed chunks for {subject}: {e}")
+        
+        print(f"✓ Loaded {subject}: {len(chunks)} chunks")
+        return chunks
+    
+    def _load_index(self, subject):
+        _, index_path = self._paths[subject]
+        
+        # IO_FLAG_MMAP only maps the inverted lists of IVF indices (paged in on demand and shared
+        # between workers through the page cache); flat and HNSW indices are still read onto the heap
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        
+        # Indices rebuilt as HNSW graphs or IVF-SQ8 need their search breadth set; flat indices are left as-is
+        if hasattr(index, "hnsw"):
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        elif hasattr(index, "nprobe"):
+            index.nprobe = IVF_NPROBE
+        
+        if FAISS_GPU_BUILD and faiss.get_num_gpus() > 0:
+            index = self._to_gpu(subject, index)
+        
+        print(f"✓ Loaded {subject} index: {index.ntotal} vectors")
+        return index
+    
+    def _to_gpu(self, subject, index):
+        # Flat and IVF indices have GPU versions; HNSW does not, so it stays on the CPU
+        try:
+            if self._gpu_resources is None:
+                self._gpu_resources = faiss.StandardGpuResources()
+            return LockedIndex(faiss.index_cpu_to_gpu(self._gpu_resources, 0, index), self._gpu_lock)
+        except Exception as e:
+            print(f"⚠️ Keeping {subject} index on CPU: {e}")
+            return index
 
-print(f"✓ Biology: {len(SUBJECTS['biology']['chunks'])} chunks")
-print(f"✓ Chemistry: {len(SUBJECTS['chemistry']['chunks'])} chunks")
-print(f"✓ Physics: {len(SUBJECTS['physics']['chunks'])} chunks")
+print("\nStep 4: Registering subject data (loaded on first use)...")
+SUBJECTS = SubjectLoader(
+    {
+        "biology": (bio_chunks_path, faiss_bio_path),
+        "chemistry": (chem_chunks_path, faiss_chem_path),
+        "physics": (phy_chunks_path, faiss_phy_path)
+    },
+    max_resident=int(os.environ.get("MAX_RESIDENT_SUBJECTS", 2))
+)
+print(f"✓ {', '.join(s.title() for s in SUBJECTS)}")
 
 print("\n" + "=" * 50)
 print("✓ ALL SYSTEMS READY!")
@@ -181,40 +671,438 @@ print("=" * 50 + "\n")
 # ------------------------------
 # Caching
 # ------------------------------
-MCQ_CACHE = {}
 MAX_CACHE_SIZE = 100
+CACHE_TTL = 3600  # seconds
+
+# LRU eviction with per-entry expiry, so hot topics stay cached
+MCQ_CACHE = TTLCache(maxsize=MAX_CACHE_SIZE, ttl=CACHE_TTL)
+
+# Topics the model rejected for a subject; repeats skip RAG and the Groq call
+TOPIC_MISMATCH_CACHE = TTLCache(maxsize=1024, ttl=CACHE_TTL)
 
 def get_cache_key(topic, subject, context_hash):
     return f"{subject}:{topic}:{context_hash}"
 
+# cachetools caches are not thread-safe (even reads reorder/expire entries) and Flask serves requests on threads
+CACHE_LOCK = threading.Lock()
+
+def get_mismatch_key(topic, subject):
+    return (subject, topic.strip().lower())
+
 def cache_mcq(key, mcqs):
-    if len(MCQ_CACHE) >= MAX_CACHE_SIZE:
-        MCQ_CACHE.pop(next(iter(MCQ_CACHE)))
-    MCQ_CACHE[key] = mcqs
+    with CACHE_LOCK:
+        MCQ_CACHE[key] = mcqs
+
+def get_cached_mcq(key):
+    with CACHE_LOCK:
+        return MCQ_CACHE.get(key)
+
+def cache_mismatch(topic, subject, error_msg):
+    with CACHE_LOCK:
+        TOPIC_MISMATCH_CACHE[get_mismatch_key(topic, subject)] = error_msg
+
+def get_cached_mismatch(topic, subject):
+    with CACHE_LOCK:
+        return TOPIC_MISMATCH_CACHE.get(get_mismatch_key(topic, subject))
+
+def read_shared_cache(path, version):
+    """
+    The state saved at path, or None if there is none or it was written for another version
+    """
+    try:
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    if isinstance(saved, dict) and saved.get("version") == version:
+        return saved["state"]
+    return None
+
+def save_shared_cache(path, version, merge):
+    """
+    Rewrite a cache file that every worker saves to at exit
+    merge(saved) gets the state now on disk (None if missing or outdated) and returns the state to
+    write; saves hold an flock on path + ".lock", so workers can't drop each other's entries
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".lock", "w") as lock_file:
+        if FCNTL_AVAILABLE:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        state = merge(read_shared_cache(path, version))
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"version": version, "state": state}, f)
+        os.replace(tmp_path, path)
+
+class SemanticCache:
+    """
+    Generated MCQs keyed by topic embedding, so paraphrased topics reuse an earlier result
+    Keeps one inner-product index per (subject, num_questions); embeddings are normalized,
+    so scores are cosine similarities
+    """
+    def __init__(self, dim, threshold=0.92, max_entries=1000, version=None):
+        self.dim = dim
+        self.version = version
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._indexes = {}
+        self._entries = {}
+        # (embedding, value) pairs added by this process, merged into the saved file at exit
+        self._added = {}
+        self._lock = threading.Lock()
+    
+    def lookup(self, subject, num_questions, q_emb):
+        key = (subject, num_questions)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None or index.ntotal == 0:
+                return None
+            
+            D, I = index.search(np.ascontiguousarray(q_emb, dtype="float32"), 1)
+            if D[0, 0] < self.threshold:
+                return None
+            return self._entries[key][I[0, 0]]
+    
+    def add(self, subject, num_questions, q_emb, value):
+        key = (subject, num_questions)
+        with self._lock:
+            index = self._indexes.setdefault(key, faiss.IndexFlatIP(self.dim))
+            entries = self._entries.setdefault(key, [])
+            
+            # Full: drop the oldest half (flat index ids shift down in step with the list)
+            if index.ntotal >= self.max_entries:
+                drop = self.max_entries // 2
+                index.remove_ids(faiss.IDSelectorRange(0, drop))
+                del entries[:drop]
+            
+            emb = np.ascontiguousarray(q_emb, dtype="float32")
+            index.add(emb)
+            entries.append(value)
+            added = self._added.setdefault(key, [])
+            added.append((emb, value))
+            del added[:-self.max_entries]
+    
+    def save(self, path):
+        # Only processes that added entries write, so a gunicorn master can't clobber its workers
+        with self._lock:
+            added = {key: list(pairs) for key, pairs in self._added.items()}
+        if not added:
+            return
+        
+        def merge(saved):
+            # Other workers' entries are already on disk: append this process's after them
+            state = dict(saved or {})
+            for key, pairs in added.items():
+                if key in state:
+                    index_bytes, entries = state[key]
+                    index = faiss.deserialize_index(index_bytes)
+                    vectors = index.reconstruct_n(0, index.ntotal)
+                else:
+                    entries, vectors = [], np.empty((0, self.dim), dtype="float32")
+                
+                vectors = np.vstack([vectors] + [emb for emb, _ in pairs])[-self.max_entries:]
+                entries = (entries + [value for _, value in pairs])[-self.max_entries:]
+                index = faiss.IndexFlatIP(self.dim)
+                index.add(vectors)
+                state[key] = (faiss.serialize_index(index), entries)
+            return state
+        
+        try:
+            save_shared_cache(path, self.version, merge)
+            print(f"✓ Saved semantic cache to {path}")
+        except OSError as e:
+            print(f"⚠️ Could not save semantic cache: {e}")
+    
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        
+        try:
+            state = read_shared_cache(path, self.version)
+            if state is None:
+                # Built from other chunks/indices or an older prompt: drop it rather than serve stale MCQs
+                os.remove(path)
+                print("✓ Discarded outdated semantic cache")
+                return
+            with self._lock:
+                for key, (index_bytes, entries) in state.items():
+                    self._indexes[key] = faiss.deserialize_index(index_bytes)
+                    self._entries[key] = entries
+            print(f"✓ Loaded semantic cache ({sum(len(e) for e in self._entries.values())} entries)")
+        except Exception as e:
+            print(f"⚠️ Could not load semantic cache: {e}")
+
+class ResponseCache:
+    """
+    Finished /generate responses keyed by (version, subject, topic, num_questions)
+    Generation is greedy, so a repeat request can skip classification, RAG and Groq entirely
+    """
+    def __init__(self, maxsize=512, version=None):
+        self.version = version
+        self._cache = LRUCache(maxsize=maxsize)
+        self._dirty = False
+        self._lock = threading.Lock()
+    
+    def key(self, topic, subject, num_questions):
+        return (self.version, subject, topic.strip().lower(), num_questions)
+    
+    def get(self, topic, subject, num_questions):
+        with self._lock:
+            return self._cache.get(self.key(topic, subject, num_questions))
+    
+    def set(self, topic, subject, num_questions, value):
+        with self._lock:
+            self._cache[self.key(topic, subject, num_questions)] = value
+            self._dirty = True
+    
+    def save(self, path):
+        # Same rule as SemanticCache: only processes that added entries write
+        with self._lock:
+            if not self._dirty:
+                return
+            items = list(self._cache.items())
+        
+        def merge(saved):
+            # Entries on disk first, so this process's (most recently used) survive the size cap
+            merged = LRUCache(maxsize=self._cache.maxsize)
+            for key, value in (saved or []) + items:
+                merged[key] = value
+            return list(merged.items())
+        
+        try:
+            save_shared_cache(path, self.version, merge)
+            print(f"✓ Saved response cache to {path}")
+        except OSError as e:
+            print(f"⚠️ Could not save response cache: {e}")
+    
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        
+        try:
+            state = read_shared_cache(path, self.version)
+            if state is None:
+                os.remove(path)
+                print("✓ Discarded outdated response cache")
+                return
+            with self._lock:
+                for key, value in state:
+                    self._cache[key] = value
+            print(f"✓ Loaded response cache ({len(self._cache)} entries)")
+        except Exception as e:
+            print(f"⚠️ Could not load response cache: {e}")
+
+# Both caches are persisted across restarts
+CACHE_DIR = os.environ.get("CACHE_DIR", "cache")
+
+# Persisted MCQs are only valid for the data and prompts they were generated from. Hub files resolve
+# to content-addressed blobs, so their names change with the data; bump CACHE_VERSION for prompt,
+# generation-setting or file-format changes
+CACHE_VERSION = 2
+CACHE_DATA_VERSION = xxhash.xxh3_64_hexdigest(repr((CACHE_VERSION, [
+    os.path.basename(os.path.realpath(path))
+    for path in (bio_chunks_path, faiss_bio_path, chem_chunks_path, faiss_chem_path, phy_chunks_path, faiss_phy_path)
+])))
+
+# Paraphrased topics hit this before Groq
+SEMANTIC_CACHE_PATH = os.path.join(CACHE_DIR, "semantic_cache.pkl")
+SEMANTIC_CACHE = SemanticCache(EMBED_DIM, threshold=0.92, version=CACHE_DATA_VERSION)
+SEMANTIC_CACHE.load(SEMANTIC_CACHE_PATH)
+atexit.register(SEMANTIC_CACHE.save, SEMANTIC_CACHE_PATH)
+
+# Exact repeats hit this before anything else in /generate
+RESPONSE_CACHE_PATH = os.path.join(CACHE_DIR, "response_cache.pkl")
+RESPONSE_CACHE = ResponseCache(maxsize=512, version=CACHE_DATA_VERSION)
+RESPONSE_CACHE.load(RESPONSE_CACHE_PATH)
+atexit.register(RESPONSE_CACHE.save, RESPONSE_CACHE_PATH)
 
 # ------------------------------
 # RAG Search
 # ------------------------------
+# Topic embeddings, so repeat topics skip the encoder entirely
+EMBED_CACHE = LRUCache(maxsize=512)
+EMBED_CACHE_LOCK = threading.Lock()
+
+def encode_queries(queries):
+    """
+    Encode queries into normalized embeddings, one row per query
+    Cached queries come from EMBED_CACHE, the rest are encoded in a single batch
+    """
+    # MiniLM's tokenizer lowercases anyway, so case/whitespace variants share one embedding
+    queries = [q.strip().lower() for q in queries]
+    with EMBED_CACHE_LOCK:
+        embs = {q: EMBED_CACHE.get(q) for q in queries}
+    
+    missing = [q for q, emb in embs.items() if emb is None]
+    if missing:
+        new_embs = embed_model.encode(missing, batch_size=32, normalize_embeddings=True, show_progress_bar=False)
+        with EMBED_CACHE_LOCK:
+            for q, emb in zip(missing, new_embs):
+                EMBED_CACHE[q] = emb
+                embs[q] = emb
+    
+    return np.vstack([embs[q] for q in queries])
+
+class SearchBatcher:
+    """
+    Coalesces concurrent rag_search calls: queries arriving within `window_ms`
+    are encoded together and searched with one index.search per subject
+    """
+    def __init__(self, window_ms=10, max_batch=32):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def submit(self, query, subject, k=5):
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((query, subject, k, future))
+        return future
+    
+    def _ensure_worker(self):
+        # Started lazily so a forking server gets a live worker thread in each process
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                self._process(batch)
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+    
+    def _process(self, batch):
+        q_embs = encode_queries([query for query, _, _, _ in batch])
+        
+        # Group rows so each subject index is searched once per batch
+        groups = {}
+        for row, (_, subject, k, future) in enumerate(batch):
+            groups.setdefault((subject, k), []).append((row, future))
+        
+        for (subject, k), members in groups.items():
+            chunks = SUBJECTS[subject]["chunks"]
+            index = SUBJECTS[subject]["index"]
+            
+            rows = [row for row, _ in members]
+            D, I = index.search(q_embs[rows], k)
+            
+            for (row, future), ids in zip(members, I):
+                context = chunks.join(ids, limit=CONTEXT_CHAR_LIMIT)
+                future.set_result((context, q_embs[row:row + 1]))
+
+# Only this much retrieved text reaches the prompt, so stop decoding chunks once it is filled
+CONTEXT_CHAR_LIMIT = 1500
+
+# Coalescing window and batch cap are tunable: longer windows batch more under load but add idle latency
+SEARCH_BATCHER = SearchBatcher(
+    window_ms=float(os.environ.get("BATCH_WINDOW_MS", 10)),
+    max_batch=int(os.environ.get("BATCH_MAX_SIZE", 32))
+)
+
+# Chunk files are immutable for the life of the process, so retrieved contexts never go stale
+RAG_CACHE = LRUCache(maxsize=1024)
+RAG_CACHE_LOCK = threading.Lock()
+
+@cached(RAG_CACHE, key=lambda query, subject, k=5: (subject, query.strip().lower(), k), lock=RAG_CACHE_LOCK)
 def rag_search(query, subject, k=5):
+    """
+    Returns (context, q_emb) so callers can reuse the query embedding
+    Goes through SEARCH_BATCHER so concurrent requests share one encode and search
+    """
     if subject not in SUBJECTS:
-        return None
+        return None, None
     
-    chunks = SUBJECTS[subject]["chunks"]
-    index = SUBJECTS[subject]["index"]
-    
-    q_emb = embed_model.encode([query], show_progress_bar=False).astype("float32")
-    D, I = index.search(q_emb, k)
+    return SEARCH_BATCHER.submit(query, subject, k).result()
+
+def warm_up(num_subjects):
+    """
+    Load and search the first few subjects once per worker, so the first request doesn't pay
+    for reading the index, paging it in and spinning up the OpenMP team
+    Searches directly rather than through SEARCH_BATCHER, whose thread starts on first use
+    """
+    q_emb = encode_queries(["warmup"])
+    for subject in list(SUBJECTS)[:num_subjects]:
+        SUBJECTS[subject]["index"].search(q_emb, 1)
+    print(f"✓ Warmed up {min(num_subjects, len(list(SUBJECTS)))} subject(s)")
+
+def init_worker():
+    """
+    Per-process setup that must not happen before a fork
+    Called from gunicorn's post_fork hook, or directly when running app.py
+    """
+    # The master only built the ORT session; give this process its own thread pool
+    if isinstance(embed_model, OnnxEncoder):
+        embed_model.load_session()
+    elif EMBED_DEVICE != "cpu":
+        embed_model.to(EMBED_DEVICE)
+        print(f"✓ Embedding model moved to {EMBED_DEVICE} (pid {os.getpid()})")
     
-    results = []
-    for idx in I[0]:
-        if idx < len(chunks):
-            results.append(chunks[idx])
+    # First encode in this process, on the final device
+    chapter_embeddings()
     
-    return "\n\n".join(results)
+    # First FAISS search happens here, so its OpenMP team is created in the worker
+    if os.environ.get("WARMUP", "1") == "1":
+        warm_up(SUBJECTS.max_resident)
 
 # ------------------------------
 # Topic Validation (Check if topic belongs to subject)
 # ------------------------------
+def classify_topic_subject(q_emb):
+    """
+    Pick the subject whose closest chapter title is most similar to the topic
+    Returns (subject, margin) where margin is the lead over the runner-up subject
+    """
+    _, all_chapter_emb = chapter_embeddings()
+    sims = all_chapter_emb @ q_emb[0]
+    best = sorted(
+        ((float(sims[CHAPTER_SUBJECT == subject].max()), subject) for subject in CHAPTER_NAMES),
+        reverse=True
+    )
+    return best[0][1], best[0][0] - best[1][0]
+
+# One thread per subject index; FAISS releases the GIL while searching
+SUBJECT_SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=len(CHAPTER_NAMES), thread_name_prefix="subject-search")
+
+def classify_topic_by_retrieval(q_emb):
+    """
+    Fallback for topics the chapter titles can't place: search every subject's index in parallel
+    and pick the one holding the closest chunk. Returns (subject, margin) like classify_topic_subject
+    """
+    # Indices only: they stay resident, so this never evicts or reloads a subject's chunks
+    indexes = {subject: SUBJECTS.index(subject) for subject in CHAPTER_NAMES}
+    
+    def top_score(index):
+        D, _ = index.search(q_emb, 1)
+        # Inner-product indices score by cosine; L2 ones by squared distance, which for unit
+        # vectors is 2 - 2*cosine
+        if index.metric_type == faiss.METRIC_L2:
+            return 1.0 - float(D[0, 0]) / 2
+        return float(D[0, 0])
+    
+    scores = dict(zip(indexes, SUBJECT_SEARCH_EXECUTOR.map(top_score, indexes.values())))
+    best = sorted(((score, subject) for subject, score in scores.items()), reverse=True)
+    return best[0][1], best[0][0] - best[1][0]
+
+def topic_mismatch_message(topic, subject):
+    return f"❌ The topic '{topic}' does not belong to {subject.title()}.\n\nPlease enter a topic related to {subject.title()} or select the correct subject."
+
 def validate_topic_subject(topic, subject):
     """
     Validate if the topic belongs to the selected subject using LLM
@@ -234,7 +1122,7 @@ Answer ONLY with "YES" if the topic belongs to {subject.title()}, or "NO" if it
 Answer:"""
     
     try:
-        response = groq_client.chat.completions.create(
+        response = groq_chat(
             messages=[
                 {
                     "role": "system",
@@ -266,46 +1154,55 @@ Answer:"""
 # ------------------------------
 # Chapter Detection (Using Actual Chapter Names)
 # ------------------------------
+def match_chapter(topic, subject, q_emb=None):
+    """
+    Match a topic to a chapter by cosine similarity against the chapter title embeddings
+    Pass the q_emb already computed by rag_search to avoid encoding the topic again
+    Returns (chapter, score) for the best-scoring chapter
+    """
+    if q_emb is None:
+        q_emb = encode_queries([topic])
+    
+    # One GEMV against the precomputed (normalized) chapter embeddings
+    chapter_emb, _ = chapter_embeddings()
+    scores = chapter_emb[subject] @ q_emb[0]
+    best = int(np.argmax(scores))
+    return CHAPTER_NAMES[subject][best], float(scores[best])
+
+_NUM_PREFIX_RE = re.compile(r'^\d+\.\s*')
+
+def resolve_chapter(name, chapters):
+    """
+    Map a chapter name returned by the LLM onto our chapter list
+    Returns None if it doesn't correspond to any listed chapter
+    """
+    # Remove number prefix if present
+    name = _NUM_PREFIX_RE.sub('', name).strip()
+    if not name:
+        return None
+    
+    for ch in chapters:
+        if ch.lower() in name.lower() or name.lower() in ch.lower():
+            return ch
+    return None
+
 def detect_chapter_from_list(context, topic, subject):
     """
-    Detect chapter using the actual chapter list by matching keywords
+    Detect chapter by cosine similarity between the topic and the chapter title embeddings
+    Falls back to the LLM when no chapter is a confident match
     Returns None if topic doesn't match the subject
     """
     if subject not in CHAPTER_NAMES:
         return None
     
-    chapters = CHAPTER_NAMES[subject]
-    combined_text = (topic + " " + context[:1000]).lower()
-    
-    # Score each chapter based on keyword matching
-    scores = {}
-    for chapter in chapters:
-        score = 0
-        chapter_words = chapter.lower().split()
-        
-        # Check if chapter words appear in the content
-        for word in chapter_words:
-            if len(word) > 3:  # Ignore small words like "and", "the"
-                if word in combined_text:
-                    score += 1
-        
-        # Bonus if topic is similar to chapter name
-        topic_words = topic.lower().split()
-        for t_word in topic_words:
-            if len(t_word) > 3 and t_word in chapter.lower():
-                score += 2
-        
-        if score > 0:
-            scores[chapter] = score
-    
-    # Return chapter with highest score
-    if scores:
-        best_chapter = max(scores.items(), key=lambda x: x[1])[0]
-        print(f"✓ Matched chapter: {best_chapter} (score: {scores[best_chapter]})")
-        return best_chapter
+    chapter, score = match_chapter(topic, subject)
+    
+    if score >= CHAPTER_MATCH_THRESHOLD:
+        print(f"✓ Matched chapter: {chapter} (score: {score:.2f})")
+        return chapter
     
     # Fallback: Use LLM to choose from the list
-    return detect_chapter_with_llm(context, topic, subject, chapters)
+    return detect_chapter_with_llm(context, topic, subject, CHAPTER_NAMES[subject])
 
 def detect_chapter_with_llm(context, topic, subject, chapters):
     """
@@ -328,7 +1225,7 @@ If it matches, respond with ONLY the chapter number and name exactly as listed (
 Response:"""
     
     try:
-        response = groq_client.chat.completions.create(
+        response = groq_chat(
             messages=[
                 {
                     "role": "system",
@@ -351,14 +1248,11 @@ Response:"""
             print(f"⚠️ Topic '{topic}' doesn't belong to {subject}")
             return None
         
-        # Extract chapter name from response (remove number prefix if present)
-        chapter = re.sub(r'^\d+\.\s*', '', result).strip()
-        
         # Verify it's in our list
-        for ch in chapters:
-            if ch.lower() in chapter.lower() or chapter.lower() in ch.lower():
-                print(f"✓ LLM detected chapter: {ch}")
-                return ch
+        chapter = resolve_chapter(result, chapters)
+        if chapter:
+            print(f"✓ LLM detected chapter: {chapter}")
+            return chapter
         
         print(f"⚠️ LLM response not in list: {result}")
         return None
@@ -370,43 +1264,18 @@ Response:"""
 # ------------------------------
 # MCQ Generation
 # ------------------------------
-def generate_mcqs(context, topic, subject, num_questions=5):
-    # Check if Groq is available
-    if not groq_client:
-        error_msg = """ERROR: Groq API not initialized!
-Please check:
-1. GROQ_API_KEY is set in Space Settings → Repository secrets
-2. API key is valid (get one from https://console.groq.com/keys)
-3. Space has been restarted after adding the key
-Current status: API key not found or invalid."""
-        return error_msg, None
-    
-    # Check cache
-    context_hash = hashlib.md5(context.encode()).hexdigest()[:8]
-    cache_key = get_cache_key(topic, subject, context_hash) + f":{num_questions}"
-    
-    if cache_key in MCQ_CACHE:
-        print("✓ Using cached MCQs")
-        return MCQ_CACHE[cache_key]["mcqs"], MCQ_CACHE[cache_key]["chapter"]
-    
-    print(f"🤖 Generating {num_questions} MCQs for {subject} - {topic}")
-    
-    # Detect the chapter from our actual chapter list
-    chapter = detect_chapter_from_list(context, topic, subject)
-    
-    # If chapter is None, topic doesn't belong to this subject
-    if chapter is None:
-        error_msg = f"❌ The topic '{topic}' does not belong to {subject.title()}.\n\nPlease enter a topic related to {subject.title()} or select the correct subject."
-        print(f"⚠️ Topic mismatch: '{topic}' not in {subject}")
-        return error_msg, None
-    
-    prompt = f"""You are a Class-12 {subject.title()} teacher creating MCQs.
-Topic: "{topic}"
-Chapter: "{chapter}"
-Reference material from textbook:
-{context[:1500]}
-Generate exactly {num_questions} multiple-choice questions based on the reference material.
-FORMAT (follow EXACTLY):
+# Topic validation, chapter detection and MCQ generation share a single Groq call.
+# validate_topic_subject / detect_chapter_with_llm above are kept for debugging only.
+# The system prompt is fully static per subject and comes first, so Groq can reuse the
+# cached prefix across requests; everything request-specific goes in the short user message.
+SYSTEM_PROMPT_TMPL = string.Template("""You are an expert Class-12 $Subject teacher who creates high-quality MCQs from textbook content. You can recognize when a topic belongs to a different subject. You always answer with a single JSON object in the exact format specified.
+Available $Subject chapters:
+$chapter_list
+For the topic and reference material given by the user, complete ALL steps below and reply with ONE JSON object with the keys "valid", "chapter" and "mcqs".
+STEP 1 - "valid": true if the topic belongs to Class 12 $Subject, false if it belongs to a different subject.
+STEP 2 - "chapter": the chapter name exactly as listed above that the topic and material belong to.
+STEP 3 - "mcqs": exactly the requested number of multiple-choice questions based on the reference material, as a single string.
+FORMAT of "mcqs" (follow EXACTLY, one item per line):
 Q1. [Question based on material]
 A) [Option 1]
 B) [Option 2]
@@ -419,23 +1288,116 @@ B) [Option 2]
 C) [Option 3]
 D) [Option 4]
 Answer: [A/B/C/D] - [Brief explanation]
-Continue for Q3, Q4, Q5{"..." if num_questions > 5 else ""}.
+Continue with Q3, Q4, ... until the requested number of questions is reached.
 REQUIREMENTS:
 - All questions must be answerable from the reference material
 - All 4 options should be plausible
 - Correct answer must be clearly supported by material
 - Keep explanations brief (1-2 sentences)
-Generate {num_questions} MCQs now:"""
+- If "valid" is false, set "chapter" and "mcqs" to empty strings
+EXAMPLE reply for a request of 1 MCQ:
+$example""")
+
+# One worked reply per subject; part of the static system prompt, so it stays in the cacheable prefix
+EXAMPLE_REPLIES = {
+    "biology": {
+        "valid": True,
+        "chapter": "Inheritance and Variation",
+        "mcqs": "Q1. In a monohybrid cross between pure tall and pure dwarf pea plants, what is the phenotypic ratio in the F2 generation?\n"
+                "A) 1:1\nB) 3:1\nC) 1:2:1\nD) 9:3:3:1\n"
+                "Answer: B - Tall is dominant, so three of every four F2 plants are tall."
+    },
+    "chemistry": {
+        "valid": True,
+        "chapter": "Solutions",
+        "mcqs": "Q1. Which of the following is a colligative property?\n"
+                "A) Viscosity\nB) Surface tension\nC) Osmotic pressure\nD) Refractive index\n"
+                "Answer: C - Osmotic pressure depends only on the number of solute particles, not their nature."
+    },
+    "physics": {
+        "valid": True,
+        "chapter": "Rotational Dynamics",
+        "mcqs": "Q1. If no external torque acts on a rotating body, which quantity remains constant?\n"
+                "A) Angular velocity\nB) Angular momentum\nC) Moment of inertia\nD) Kinetic energy\n"
+                "Answer: B - Zero external torque means the rate of change of angular momentum is zero."
+    }
+}
+
+USER_PROMPT_TMPL = string.Template("""Topic: "$topic"
+${hint}Reference material from textbook:
+$context
+Generate exactly $n MCQs now. JSON:""")
+
+SYSTEM_PROMPTS = {
+    subject: SYSTEM_PROMPT_TMPL.substitute(
+        Subject=subject.title(),
+        chapter_list="\n".join(f"{i+1}. {ch}" for i, ch in enumerate(chapters)),
+        example=json.dumps(EXAMPLE_REPLIES[subject])
+    )
+    for subject, chapters in CHAPTER_NAMES.items()
+}
+
+# Sampling temperature for ?nocache=1 requests, which want a different set of questions
+FRESH_TEMPERATURE = 0.7
+
+def generate_mcqs(context, topic, subject, num_questions=5, q_emb=None, subject_confirmed=False, fresh=False):
+    """
+    Returns (mcqs, chapter, status); on failure chapter is None, mcqs holds the error message and
+    status is the HTTP code: 400 for a topic/subject mismatch, 502/504 for Groq failures and timeouts
+    """
+    # Check if Groq is available
+    if not groq_client:
+        error_msg = """ERROR: Groq API not initialized!
+Please check:
+1. GROQ_API_KEY is set in Space Settings → Repository secrets
+2. API key is valid (get one from https://console.groq.com/keys)
+3. Space has been restarted after adding the key
+Current status: API key not found or invalid."""
+        return error_msg, None, 503
+    
+    # Check cache
+    # Non-cryptographic key: xxh3 is far cheaper than md5 and hashes the str directly
+    # (context is already capped at CONTEXT_CHAR_LIMIT by rag_search)
+    context_hash = xxhash.xxh3_64_hexdigest(context)
+    cache_key = get_cache_key(topic, subject, context_hash) + f":{num_questions}"
+    
+    cached_mcqs = None if fresh else get_cached_mcq(cache_key)
+    if cached_mcqs:
+        print("✓ Using cached MCQs")
+        RESPONSE_CACHE.set(topic, subject, num_questions, {"mcqs": cached_mcqs["mcqs"], "subject": subject, "chapter": cached_mcqs["chapter"]})
+        return cached_mcqs["mcqs"], cached_mcqs["chapter"], 200
+    
+    # Close paraphrase of an earlier topic: reuse its MCQs instead of calling Groq
+    if q_emb is not None and not fresh:
+        cached_mcqs = SEMANTIC_CACHE.lookup(subject, num_questions, q_emb)
+        if cached_mcqs:
+            print("✓ Using semantically cached MCQs")
+            RESPONSE_CACHE.set(topic, subject, num_questions, {"mcqs": cached_mcqs["mcqs"], "subject": subject, "chapter": cached_mcqs["chapter"]})
+            return cached_mcqs["mcqs"], cached_mcqs["chapter"], 200
+    
+    print(f"🤖 Generating {num_questions} MCQs for {subject} - {topic}")
+    
+    # Local embedding match gives the model a hint (and us a fallback) for the chapter
+    chapters = CHAPTER_NAMES[subject]
+    chapter_hint, score = match_chapter(topic, subject, q_emb)
+    hint = f'Most likely chapter: "{chapter_hint}"\n' if score >= CHAPTER_MATCH_THRESHOLD else ""
+    
+    prompt = USER_PROMPT_TMPL.substitute(
+        topic=topic,
+        hint=hint,
+        context=context,
+        n=num_questions
+    )
     
     try:
-        # Adjust max_tokens based on number of questions
-        max_tokens = min(3000, 300 * num_questions)
+        # Adjust max_tokens based on number of questions (plus room for the JSON envelope)
+        max_tokens = min(3000, 300 * num_questions + 100)
         
-        chat_completion = groq_client.chat.completions.create(
+        chat_completion = groq_chat(
             messages=[
                 {
                     "role": "system",
-                    "content": "You are an expert Class-12 teacher who creates high-quality MCQs from textbook content. You always follow the exact format specified."
+                    "content": SYSTEM_PROMPTS[subject]
                 },
                 {
                     "role": "user",
@@ -443,19 +1405,48 @@ Generate {num_questions} MCQs now:"""
                 }
             ],
             model="llama-3.3-70b-versatile",
-            temperature=0.3,
+            # Greedy: the same topic and material give the same MCQs, which is what the caches assume
+            temperature=FRESH_TEMPERATURE if fresh else 0,
             max_tokens=max_tokens,
-            top_p=0.9
+            response_format={"type": "json_object"}
         )
         
-        result = chat_completion.choices[0].message.content.strip()
-        result = clean_mcq_output(result)
+        try:
+            data = json.loads(chat_completion.choices[0].message.content)
+        except json.JSONDecodeError as e:
+            print(f"❌ Groq returned invalid JSON: {e}")
+            return "Error: the model returned a malformed response. Please try again.", None, 502
+        
+        # If the model says the topic is from another subject, report a mismatch
+        # (unless the local classifier already confirmed the subject).
+        # Only a real JSON true counts - the string "false" would be truthy
+        if not subject_confirmed and data.get("valid") is not True:
+            error_msg = topic_mismatch_message(topic, subject)
+            print(f"⚠️ Topic mismatch: '{topic}' not in {subject}")
+            cache_mismatch(topic, subject, error_msg)
+            return error_msg, None, 400
+        
+        chapter = resolve_chapter(str(data.get("chapter", "")), chapters) or chapter_hint
+        print(f"✓ Chapter: {chapter}")
         
-        # Cache both MCQs and chapter
-        cache_mcq(cache_key, {"mcqs": result, "chapter": chapter})
+        result = clean_mcq_output(str(data.get("mcqs", "")).strip())
+        if not result.strip():
+            print("❌ Groq returned no MCQs")
+            return "Error: the model returned no questions. Please try again.", None, 502
+        
+        # Cache both MCQs and chapter (sampled results are one-offs, so they aren't cached)
+        if not fresh:
+            cache_mcq(cache_key, {"mcqs": result, "chapter": chapter})
+            RESPONSE_CACHE.set(topic, subject, num_questions, {"mcqs": result, "subject": subject, "chapter": chapter})
+            if q_emb is not None:
+                SEMANTIC_CACHE.add(subject, num_questions, q_emb, {"mcqs": result, "chapter": chapter})
         
         print("✓ MCQs generated successfully")
-        return result, chapter
+        return result, chapter, 200
+    
+    except (FutureTimeoutError, APITimeoutError) as e:
+        print(f"❌ Groq API timed out: {e}")
+        return f"Error: the Groq API did not respond within {GROQ_TIMEOUT:.0f}s. Please try again.", None, 504
         
     except Exception as e:
         error_msg = f"""Error calling Groq API: {str(e)}
@@ -465,25 +1456,25 @@ Possible causes:
 3. Network issue
 Please try again in a few seconds."""
         print(f"❌ Groq API Error: {e}")
-        return error_msg, chapter
+        return error_msg, None, 502
 
-def clean_mcq_output(text):
-    lines = text.split('\n')
-    cleaned_lines = []
-    
-    for line in lines:
+# Question, option and answer lines; group 1 marks "Correct Answer:" for normalization
+_MCQ_LINE_RE = re.compile(r'^(?:Q\d+\.|[A-D]\)|Answer:|(Correct\s+Answer:))')
+
+def _clean_mcq_lines(text):
+    for line in text.split('\n'):
         line = line.strip()
         
-        if (re.match(r'^Q\d+\.', line) or 
-            line.startswith(('A)', 'B)', 'C)', 'D)', 'Answer:', 'Correct Answer:')) or
-            not line):
-            
-            if line.startswith('Correct Answer:'):
-                line = line.replace('Correct Answer:', 'Answer:')
-            
-            cleaned_lines.append(line)
-    
-    return '\n'.join(cleaned_lines)
+        if not line:
+            yield line
+            continue
+        
+        match = _MCQ_LINE_RE.match(line)
+        if match:
+            yield 'Answer:' + line[match.end():] if match.group(1) else line
+
+def clean_mcq_output(text):
+    return '\n'.join(_clean_mcq_lines(text))
 
 # ------------------------------
 # HTML UI
@@ -809,16 +1800,30 @@ HTML_TEMPLATE = """
 # ------------------------------
 # Routes
 # ------------------------------
+# The page has no template variables, so skip Jinja and serve the encoded bytes directly
+HOME_HTML = HTML_TEMPLATE.encode("utf-8")
+# ...and compress it once up front rather than on every hit
+HOME_HTML_GZIP = gzip.compress(HOME_HTML, compresslevel=9)
+
 @app.route("/")
 def home():
-    return render_template_string(HTML_TEMPLATE)
+    # Fresh Response per request - Flask-Compress rewrites the body in place
+    # (it leaves responses that already carry a Content-Encoding alone)
+    headers = {"Cache-Control": "public, max-age=3600", "Vary": "Accept-Encoding"}
+    if request.accept_encodings["gzip"]:
+        headers["Content-Encoding"] = "gzip"
+        return Response(HOME_HTML_GZIP, mimetype="text/html", headers=headers)
+    return Response(HOME_HTML, mimetype="text/html", headers=headers)
+
+MAX_TOPIC_CHARS = 512
 
 @app.route("/generate", methods=["POST"])
 def generate():
     try:
         data = request.json
         subject = data.get("subject", "").lower()
-        topic = data.get("topic", "")
+        # Bound the text we tokenize and prompt with; real topics are a few words
+        topic = data.get("topic", "").strip()[:MAX_TOPIC_CHARS]
         num_questions = data.get("num_questions", 5)
         
         # Validate num_questions
@@ -835,35 +1840,61 @@ def generate():
         if subject not in SUBJECTS:
             return jsonify({"error": "Invalid subject"}), 400
         
-        print(f"\n🔍 Validating topic for {subject}...")
+        # ?nocache=1 skips the MCQ caches and samples a fresh set of questions
+        # (known topic mismatches are still rejected from TOPIC_MISMATCH_CACHE)
+        fresh = request.args.get("nocache") == "1"
         
-        # STEP 1: Validate if topic belongs to subject (BEFORE RAG search)
-        if not validate_topic_subject(topic, subject):
-            subject_names = {
-                "biology": "Biology",
-                "chemistry": "Chemistry", 
-                "physics": "Physics"
-            }
-            error_msg = f"The topic '{topic}' does not appear to be related to {subject_names[subject]}.\n\nPlease either:\n• Enter a {subject_names[subject]}-related topic, or\n• Select the correct subject for this topic"
+        # Exact repeat: return the earlier response without any model work
+        cached_response = None if fresh else RESPONSE_CACHE.get(topic, subject, num_questions)
+        if cached_response:
+            print(f"✓ Cached response: '{topic}' ({subject}, {num_questions})")
+            return jsonify(cached_response)
+        
+        # Known mismatch: skip RAG and the Groq call
+        mismatch = get_cached_mismatch(topic, subject)
+        if mismatch:
+            print(f"✓ Cached topic mismatch: '{topic}' not in {subject}")
+            return jsonify({"error": mismatch}), 400
+        
+        # STEP 1: Classify the topic's subject locally; anything not clear-cut is left to the LLM
+        q_emb = encode_queries([topic])
+        predicted, margin = classify_topic_subject(q_emb)
+        # How well the topic fits the selected subject's own chapters, whatever else fits better
+        _, own_score = match_chapter(topic, subject, q_emb)
+        
+        # Too close to call from chapter titles: let the textbook content decide
+        if margin < SUBJECT_MARGIN:
+            predicted, margin = classify_topic_by_retrieval(q_emb)
+            print(f"🔎 Retrieval vote: {predicted} (margin: {margin:.2f})")
+        
+        # Reject locally only if the topic also fits none of the selected subject's chapters;
+        # overlapping topics ("Thermodynamics", "DNA" under chemistry) go to the fused Groq check
+        if predicted != subject and margin >= SUBJECT_MARGIN and own_score < CHAPTER_MATCH_THRESHOLD:
+            print(f"❌ Topic '{topic}' looks like {predicted}, not {subject} (margin: {margin:.2f}, own: {own_score:.2f})")
+            error_msg = topic_mismatch_message(topic, subject)
+            cache_mismatch(topic, subject, error_msg)
             return jsonify({"error": error_msg}), 400
         
-        print(f"✓ Topic validated for {subject}")
-        print(f"🔍 Searching {subject} for: {topic}")
+        # Winning by a margin isn't enough on its own: an off-syllabus topic (history, cooking) is
+        # always closest to *some* subject, so it must also fit one of the subject's chapters
+        subject_confirmed = predicted == subject and margin >= SUBJECT_MARGIN and own_score >= CHAPTER_MATCH_THRESHOLD
+        
+        print(f"\n🔍 Searching {subject} for: {topic}")
         
         # STEP 2: RAG search
-        context = rag_search(topic, subject, k=5)
+        context, q_emb = rag_search(topic, subject, k=5)
         
         if not context or len(context.strip()) < 50:
             return jsonify({"error": f"No content found for: {topic}"}), 404
         
         print(f"✓ Context found ({len(context)} chars)")
         
-        # STEP 3: Generate MCQs
-        mcqs, chapter = generate_mcqs(context, topic, subject, num_questions)
+        # STEP 3: Validate topic, detect chapter and generate MCQs (single Groq call)
+        mcqs, chapter, status = generate_mcqs(context, topic, subject, num_questions, q_emb, subject_confirmed, fresh)
         
-        # Check if there was a subject mismatch
+        # No chapter means a subject mismatch (400) or a Groq failure (502/504); mcqs holds the message
         if chapter is None:
-            return jsonify({"error": mcqs}), 400
+            return jsonify({"error": mcqs}), status
         
         return jsonify({
             "mcqs": mcqs, 
@@ -877,11 +1908,28 @@ def generate():
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
+# Health checks are polled, so a slow Groq API must not hold one for the full GROQ_TIMEOUT
+GROQ_PROBE_TIMEOUT = 5  # seconds
+
 @app.route("/health")
 def health():
+    # Probe the Groq API on health checks (not at startup) until one probe succeeds in this worker;
+    # a failed probe is retried on the next check rather than latched until restart
+    if groq_client and not app.config.get("GROQ_PROBED"):
+        future = GROQ_EXECUTOR.submit(groq_client.models.list)
+        try:
+            future.result(timeout=GROQ_PROBE_TIMEOUT)
+            app.config["GROQ_ERROR"] = None
+            app.config["GROQ_PROBED"] = True
+            print("✓ Groq API working!")
+        except Exception as e:
+            future.cancel()
+            app.config["GROQ_ERROR"] = str(e) or type(e).__name__
+            print(f"❌ Groq API check failed: {e}")
+    
     return jsonify({
         "status": "healthy",
-        "groq_available": groq_client is not None,
+        "groq_available": groq_client is not None and not app.config.get("GROQ_ERROR"),
         "cache_size": len(MCQ_CACHE)
     })
 
@@ -891,4 +1939,5 @@ def health():
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 7860))
     print(f"\n🚀 Starting server on port {port}...\n")
+    init_worker()
     app.run(host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,23 @@
+import os
+
+# Gunicorn settings (used by the Dockerfile: gunicorn -c gunicorn.conf.py app:app)
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '7860')}"
+
+# Load app.py (embedding model weights, hub downloads) once in the master before forking, so
+# workers share those pages copy-on-write instead of each loading its own copy. Nothing is
+# encoded or searched in the master: that happens in post_fork, once per worker
+preload_app = True
+
+# Threaded workers: requests mostly wait on Groq, so a few processes with many threads each
+worker_class = "gthread"
+workers = int(os.environ.get("WORKERS", "2"))
+threads = int(os.environ.get("THREADS", "8"))
+
+# Groq calls are capped at GROQ_TIMEOUT (30s), so this only catches a genuinely stuck worker
+timeout = int(os.environ.get("TIMEOUT", "120"))
+
+def post_fork(server, worker):
+    # GPU placement (and anything else that isn't fork-safe) happens in each worker, never in the master
+    import app
+    app.init_worker()
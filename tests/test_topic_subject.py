@@ -0,0 +1,43 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+# app.py loads the embedding model and downloads the subject files at import
+pytest.importorskip("sentence_transformers")
+app_module = pytest.importorskip("app")
+
+
+class FakeGroq:
+    """
+    Stands in for the Groq client: every chat completion rejects the topic
+    """
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+    
+    def create(self, **kwargs):
+        reply = json.dumps({"valid": False, "chapter": "", "mcqs": ""})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=reply))])
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app_module, "groq_client", FakeGroq())
+    return app_module.app.test_client()
+
+
+@pytest.mark.parametrize("subject", ["biology", "chemistry", "physics"])
+def test_unrelated_topic_is_a_mismatch(client, subject):
+    # Off-syllabus topics are closest to *some* subject, but must not be confirmed for it
+    topic = "French Revolution"
+    q_emb = app_module.encode_queries([topic])
+    _, own_score = app_module.match_chapter(topic, subject, q_emb)
+    assert own_score < app_module.CHAPTER_MATCH_THRESHOLD
+    
+    response = client.post(
+        "/generate?nocache=1",
+        json={"subject": subject, "topic": topic, "num_questions": 3}
+    )
+    
+    assert response.status_code == 400
+    assert "does not belong to" in response.get_json()["error"]